@@ -5,7 +5,11 @@ Note that this matching is very basic and may be incorrect due to such as
 2) noise introduced in the process of trajectory reconstruction
 '''
 
+import os
+import numpy as np
 import pandas as pd
+from utils_data import compile_metadata
+from utils_io import save_compact, load_compact, load_attributes
 
 path_cleaned = './CleanedData/'
 path_processed = './ProcessedData/'
@@ -18,19 +22,24 @@ path_matched = './MatchedEvents/'
 # or 3) the target information is not available
 uncounted_target = ['Single vehicle conflict', 'obstacle/object in roadway', 'parked vehicle', 'Other']
 
-for crash_type in ['Crash', 'NearCrash']:
+def match_events(crash_type, trips=None, path_cleaned=path_cleaned, path_processed=path_processed, path_matched=path_matched):
     print('Processing ', crash_type, ' data...')
 
-    data_ego = pd.read_hdf(path_processed + 'HundredCar_'+crash_type+'_Ego.h5', key='data')
-    data_sur = pd.read_hdf(path_processed + 'HundredCar_'+crash_type+'_Surrounding.h5', key='data')
-    meta = pd.read_csv(path_cleaned + 'HundredCar_metadata_'+crash_type+'Event.csv').set_index('webfileid')
-    meta = meta.loc[data_ego['trip_id'].unique()]
+    file_ego = path_processed + 'HundredCar_'+crash_type+'_Ego.h5'
+    file_events = path_matched + 'HundredCar_' + crash_type + 'es.h5'
+    data_ego = load_compact(file_ego, trips=trips)
+    data_sur = load_compact(path_processed + 'HundredCar_'+crash_type+'_Surrounding.h5', trips=trips)
+    attributes = load_attributes(file_ego)
+    meta_all = pd.read_csv(path_cleaned + 'HundredCar_metadata_'+crash_type+'Event.csv').set_index('webfileid')
+    meta = meta_all.loc[data_ego['trip_id'].unique()]
     meta = meta[~meta['target'].isin(uncounted_target)]
 
-    print(f'There are {data_ego['trip_id'].nunique()} trips processed')
+    print(f'There are {data_ego["trip_id"].nunique()} trips processed')
 
+    records, _ = compile_metadata(meta)
     events = []
-    for trip_id in meta.index:
+    for record in records:
+        trip_id = record['trip_id']
 
         df_ego = data_ego[data_ego['trip_id'] == trip_id]
         df_sur = data_sur[data_sur['trip_id'] == trip_id]
@@ -43,29 +52,51 @@ for crash_type in ['Crash', 'NearCrash']:
             rearward = merged[~merged['forward'].astype(bool)].groupby('target_id')['range'].min().sort_values()
             merged = merged.groupby('target_id')['range'].min().sort_values()
 
-            if ('lead' in meta.loc[trip_id]['target']) and (len(forward)>0):
+            if ('lead' in record['target']) and (len(forward)>0):
                 target_id = forward.index[0]
-            elif ('follow' in meta.loc[trip_id]['target']) and (len(rearward)>0):
+            elif ('follow' in record['target']) and (len(rearward)>0):
                 target_id = rearward.index[0]
             else:
                 target_id = merged.index[0]
 
             veh_i = df_ego[['time','x_ekf','y_ekf','psi_ekf','v_ekf','trip_id','event']].copy()
             veh_i = veh_i.rename(columns={'x_ekf':'x','y_ekf':'y','psi_ekf':'psi','v_ekf':'speed'})
-            veh_i[['width','length']] = meta.loc[trip_id][['ego_width','ego_length']].values.astype(float)
+            veh_i[['width','length']] = [record['ego_width'], record['ego_length']]
 
             veh_j = df_sur[df_sur['target_id']==target_id][['time','x_ekf','y_ekf','psi_ekf','v_ekf','target_id','range','forward']].copy()
             veh_j = veh_j.rename(columns={'x_ekf':'x','y_ekf':'y','psi_ekf':'psi','v_ekf':'speed'})
-            veh_j[['width','length']] = meta.loc[trip_id][['target_width','target_length']].values.astype(float)
+            veh_j[['width','length']] = [record['target_width'], record['target_length']]
 
             df = veh_i.merge(veh_j, on='time', suffixes=('_i', '_j'), how='inner')
             if df[df['event'].astype(bool)]['range'].min()<4.5: # so that no other vehicles can be between the ego and the target during event
                 events.append(df)
 
+    ## when matching a subset of trips, keep the events of the other trips matched before from the same processed data,
+    ## otherwise the matched events are incomplete
+    if trips is not None:
+        previous = load_attributes(file_events) if os.path.exists(file_events) else None
+        if previous is not None and dict(previous, complete=0.)==dict(attributes, complete=0.):
+            events_previous = load_compact(file_events)
+            events.insert(0, events_previous[~events_previous['trip_id'].isin(trips)])
+            attributes['complete'] = min(attributes.get('complete', 1.), previous.get('complete', 1.))
+        else:
+            attributes['complete'] = 0.
+    if len(events)==0:
+        print(f'There are no {crash_type}es matched.')
+        return
+
+    ## events in the order of the metadata
     events = pd.concat(events)
-    events.to_hdf(path_matched + 'HundredCar_' + crash_type + 'es.h5', key='data')
+    order = pd.Series(np.arange(len(meta_all)), index=meta_all.index).loc[events['trip_id']].values
+    events = events.iloc[np.argsort(order, kind='stable')].reset_index(drop=True)
+    save_compact(events, file_events, group_columns=['trip_id'],
+                 constant_columns=['width_i','length_i','target_id','width_j','length_j','forward'], attributes=attributes)
 
-    meta = meta.loc[events['trip_id'].unique()]
+    meta = meta_all.loc[events['trip_id'].unique()]
     meta.to_csv(path_matched + 'HundredCar_metadata_' + crash_type + 'es.csv')
     print(f'There are {len(meta)} {crash_type}es matched and saved.')
 
+
+if __name__ == '__main__':
+    for crash_type in ['Crash', 'NearCrash']:
+        match_events(crash_type)
@@ -1,65 +1,163 @@
 '''
 This script processes the cleaned data of 100-Car Naturalistic Driving Study.
 '''
+import os
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
 from utils_data import *
+from utils_io import save_compact, reconstruction_settings
 
 path_cleaned = './CleanedData/'
 path_processed = './ProcessedData/'
 
 
-for crash_type in ['Crash','NearCrash']:
-    invalid_trips = []
+# Reconstruct the ego and surrounding trajectories of a single trip
+# window: (pre, post) seconds around the event to reconstruct, None for the entire trip
+def process_trip(sample, trip, ego_length, event_start, event_end, fig_path, plot=True, rate=None, steady_state=False, window=None, warmup=3.):
+    ## cut the trip to the event window (with warm-up) and prune targets not alive at the event start
+    if window is not None:
+        sample, time_window = select_event_window(sample, event_start, event_end, window[0], window[1], warmup)
+
+    ## resample to a uniform rate, keeping the row where the event starts
+    sample, dt = resample_trip(sample, rate, anchor=np.searchsorted(sample[:,1], event_start))
+
+    ## create dataframe, target ids start from 0 in every trip and are offset when assembling
+    df_ego, df_forward, df_rearward = create_dataframe(sample, 0)
+
+    ## reconstruct ego trajectory and make comparison plots
+    df_ego, valid = process_ego(df_ego, trip, fig_path, plot, dt, steady_state)
+    if not valid:
+        return None, None, False
+    ## reconstruct surrounding vehicle trajectory
+    if len(df_forward)>0:
+        df_forward = df_forward[(df_forward['range']>=0)]
+        if len(df_forward)>0:
+            df_forward = process_surrounding(df_ego, df_forward, ego_length, forward=True, dt=dt, steady_state=steady_state)
+            df_forward['forward'] = 1
+    if len(df_rearward)>0:
+        df_rearward = df_rearward[(df_rearward['range']>=0)]
+        if len(df_rearward)>0:
+            df_rearward = process_surrounding(df_ego, df_rearward, ego_length, forward=False, dt=dt, steady_state=steady_state)
+            df_rearward['forward'] = 0
+    df_sur = pd.concat([df_forward, df_rearward])
+
+    ## select segments covering the event
+    time_start = df_ego[df_ego['sync']>=event_start]['time'].values[0] # the exact frames may be left out by resampling
+    time_end = df_ego[df_ego['sync']<=event_end]['time'].values[-1]
+    df_ego.loc[(df_ego['time']>=time_start)&(df_ego['time']<=time_end), 'event'] = 1
+    df_ego.loc[df_ego['event'].isna(), 'event'] = 0
+    if window is not None:
+        ## drop the warm-up, targets have been pruned already
+        df_ego = df_ego[(df_ego['time']>=time_window[0])&(df_ego['time']<=time_window[1])]
+        if len(df_sur)>0:
+            df_sur = df_sur[(df_sur['time']>=time_window[0])&(df_sur['time']<=time_window[1])]
+    elif len(df_sur)>0:
+        df_sur = df_sur[(df_sur.groupby('target_id')['time'].transform('min')<=time_start)&
+                        (df_sur.groupby('target_id')['time'].transform('max')>time_start)]
+
+    return df_ego, df_sur, True
+
+
+# Per-trip checkpoints, so that an interrupted run resumes where it stopped
+def checkpoint_path(crash_type, trip, path_processed=path_processed):
+    return path_processed + 'checkpoints/' + crash_type + '/' + str(trip) + '.h5'
+
+
+def save_checkpoint(file_path, df_ego, df_sur, valid, settings):
+    ## write to a temporary file first so that an interruption never leaves a partial checkpoint
+    tmp_path = file_path + '.tmp'
+    pd.Series([int(valid)]).to_hdf(tmp_path, key='valid', mode='w')
+    pd.Series(settings, dtype=float).to_hdf(tmp_path, key='settings')
+    if valid:
+        df_ego.infer_objects().to_hdf(tmp_path, key='ego')
+        if len(df_sur)>0:
+            df_sur.infer_objects().to_hdf(tmp_path, key='sur')
+    os.replace(tmp_path, file_path)
+
+
+# Settings the checkpoint was made with, None for checkpoints without recorded settings
+def checkpoint_settings(file_path):
+    with pd.HDFStore(file_path, mode='r') as store:
+        if '/settings' not in store.keys():
+            return None
+        return store['settings'].to_dict()
+
+
+def load_checkpoint(file_path):
+    with pd.HDFStore(file_path, mode='r') as store:
+        valid = bool(store['valid'].iloc[0])
+        if not valid:
+            return None, None, False
+        df_ego = store['ego']
+        df_sur = store['sur'] if '/sur' in store.keys() else pd.DataFrame()
+    return df_ego, df_sur, True
+
+
+def process_crash_type(crash_type, trips=None, restart=False, plot=True, rate=None, steady_state=False, window=None, warmup=3., path_cleaned=path_cleaned, path_processed=path_processed):
     print('Processing', crash_type, 'data...')
 
-    # data loading
-    data = pd.read_csv(path_cleaned + 'HundredCar_'+crash_type+'_Public_Cleaned.csv')
-    data = data.set_index('trip_id')
-    meta = pd.read_csv(path_cleaned + 'HundredCar_metadata_'+crash_type+'Event.csv')
+    file_data = path_cleaned + 'HundredCar_'+crash_type+'_Public_Cleaned.csv'
+    file_meta = path_cleaned + 'HundredCar_metadata_'+crash_type+'Event.csv'
+    meta = pd.read_csv(file_meta)
     meta = meta.set_index('webfileid')
+    meta, trip_row = compile_metadata(meta)
+    trip_list = meta['trip_id']
+    selected = trip_list
+    if trips is not None:
+        unknown = np.setdiff1d(trips, trip_list)
+        if len(unknown)>0:
+            print('Trips not found in', crash_type, 'metadata:', unknown)
+        selected = trip_list[np.isin(trip_list, trips)]
+
+    ## a checkpoint is reused only if it is newer than the cleaned data it was made from, and made with the same settings
+    settings = reconstruction_settings(rate, steady_state, window, warmup)
+    checkpoint_dir = os.path.dirname(checkpoint_path(crash_type, 0, path_processed))
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    input_mtime = max(os.path.getmtime(file_data), os.path.getmtime(file_meta))
+    current = set()
+    for trip in trip_list:
+        file_checkpoint = checkpoint_path(crash_type, trip, path_processed)
+        if (os.path.exists(file_checkpoint) and os.path.getmtime(file_checkpoint)>=input_mtime and
+            checkpoint_settings(file_checkpoint)==settings):
+            current.add(trip)
+    to_process = [trip for trip in selected if restart or trip not in current]
+    print(len(selected)-len(to_process), 'of', len(selected), 'trips restored from checkpoints')
 
     # data processing
+    if len(to_process)>0:
+        data = pd.read_csv(file_data)
+        data = data.set_index('trip_id')
+        if rate is not None:
+            ### check the rate before processing any trip
+            dt_native = data.groupby(level=0)['time'].diff().median()
+            step = resampling_step(dt_native, rate)
+            print('Trips of', f'{1/dt_native:g}', 'Hz are resampled to', f'{1/(dt_native*step):g}', 'Hz (one in every', step, 'frames)')
+        fig_path = path_processed + 'plots_ekf/' + crash_type + '/'
+        for trip in tqdm(to_process):
+            sample = data.loc[trip].reset_index().values
+            record = meta[trip_row[trip]]
+            df_ego, df_sur, valid = process_trip(sample, trip, record['ego_length'],
+                                                 record['event_start'], record['event_end'], fig_path, plot, rate, steady_state, window, warmup)
+            save_checkpoint(checkpoint_path(crash_type, trip, path_processed), df_ego, df_sur, valid, settings)
+
+    # assemble dataframes from the checkpoints of all trips, so that processing a subset of trips updates the outputs
+    # instead of replacing them; trips without a current checkpoint are left out and the outputs marked incomplete
+    assembled = [trip for trip in trip_list if trip in current or trip in to_process]
+    complete = len(assembled)==len(trip_list)
+    if not complete:
+        print(len(trip_list)-len(assembled), 'trips are not processed with these settings yet, the outputs are incomplete')
+    invalid_trips = []
     data_ego = []
     data_sur = []
-    trip_list = meta.index.values
-    target_id = 0 # Initialize target_id for surrounding vehicles detected by radar
-    for trip in tqdm(trip_list):
-        sample = data.loc[trip].reset_index().values
-        ## create dataframe
-        df_ego, df_forward, df_rearward = create_dataframe(sample, target_id)
-
-        ## reconstruct ego trajectory and make comparison plots
-        fig_path = path_processed + 'plots_ekf/' + crash_type + '/'
-        df_ego, valid = process_ego(df_ego, trip, fig_path)
+    target_id = 0 # Offset of target_id for surrounding vehicles detected by radar
+    for trip in assembled:
+        df_ego, df_sur, valid = load_checkpoint(checkpoint_path(crash_type, trip, path_processed))
         if not valid:
             invalid_trips.append(trip)
             continue
-        ## reconstruct surrounding vehicle trajectory
-        ego_length = meta.loc[trip]['ego_length']
-        if len(df_forward)>0:
-            df_forward = df_forward[(df_forward['range']>=0)]
-            if len(df_forward)>0:
-                df_forward = process_surrounding(df_ego, df_forward, ego_length, forward=True)
-                df_forward['forward'] = 1
-        if len(df_rearward)>0:
-            df_rearward = df_rearward[(df_rearward['range']>=0)]
-            if len(df_rearward)>0:
-                df_rearward = process_surrounding(df_ego, df_rearward, ego_length, forward=False)
-                df_rearward['forward'] = 0
-        if len(df_forward)>0 or len(df_rearward)>0:
-            df_sur = pd.concat([df_forward, df_rearward])
-        
-        ## select segments covering the event
-        time_start = df_ego[df_ego['sync']==meta.loc[trip]['event start']]['time'].values[0]
-        time_end = df_ego[df_ego['sync']==meta.loc[trip]['event end']]['time'].values[0]
-        df_ego.loc[(df_ego['time']>=time_start)&(df_ego['time']<=time_end), 'event'] = 1
-        df_ego.loc[df_ego['event'].isna(), 'event'] = 0
-        df_sur = df_sur[(df_sur.groupby('target_id')['time'].transform('min')<=time_start)&
-                        (df_sur.groupby('target_id')['time'].transform('max')>time_start)]
-
-        ## append dataframes
+        if len(df_sur)>0:
+            df_sur['target_id'] = df_sur['target_id'] + target_id
         data_ego.append(df_ego)
         data_sur.append(df_sur)
         target_id += 1
@@ -68,11 +166,23 @@ for crash_type in ['Crash','NearCrash']:
     data_ego = pd.concat(data_ego).reset_index(drop=True).infer_objects()
     data_sur = pd.concat(data_sur).reset_index(drop=True).infer_objects()
     data_ego[['trip_id','sync','event']] = data_ego[['trip_id','sync','event']].astype(int)
+    data_ego[['gap','speed_valid']] = data_ego[['gap','speed_valid']].astype(bool)
     data_sur[['trip_id','target_id','forward']] = data_sur[['trip_id','target_id','forward']].astype(int)
+    data_sur['gap'] = data_sur['gap'].astype(bool)
+
+    ## with the sampling rate actually reconstructed, as the requested rate is matched within a tolerance
+    sampling_rate = 1/data_ego.groupby('trip_id')['time'].diff().median()
+    attributes = dict(settings, complete=float(complete), sampling_rate=float(f'{sampling_rate:.6g}'))
+    print('Reconstructed at', f'{sampling_rate:g}', 'Hz')
+    save_compact(data_ego, path_processed + 'HundredCar_'+crash_type+'_Ego.h5', group_columns=['trip_id'], attributes=attributes)
+    save_compact(data_sur, path_processed + 'HundredCar_'+crash_type+'_Surrounding.h5',
+                 group_columns=['trip_id','target_id'], constant_columns=['forward'], attributes=attributes)
 
-    data_ego.to_hdf(path_processed + 'HundredCar_'+crash_type+'_Ego.h5', key='data')
-    data_sur.to_hdf(path_processed + 'HundredCar_'+crash_type+'_Surrounding.h5', key='data')
-    
     # save invalid trips
     invalid_trips = np.array(invalid_trips)
-    np.savetxt(path_processed + 'HundredCar_'+crash_type+'_DataLacked.txt', invalid_trips, fmt='%d', delimiter=',')
\ No newline at end of file
+    np.savetxt(path_processed + 'HundredCar_'+crash_type+'_DataLacked.txt', invalid_trips, fmt='%d', delimiter=',')
+
+
+if __name__ == '__main__':
+    for crash_type in ['Crash','NearCrash']:
+        process_crash_type(crash_type)
@@ -0,0 +1,172 @@
+'''
+This script runs the processing pipeline of 100-Car Naturalistic Driving Study data from a single entry point.
+
+Examples:
+    python run_pipeline.py all                              # run the stale stages for both crash types
+    python run_pipeline.py process --crash-type Crash       # (re)run a single stage
+    python run_pipeline.py process --trips 8360 8453        # process a subset of trips (checkpointed ones are restored), the other trips are kept
+    python run_pipeline.py process --trips 8360 --restart   # reprocess a subset of trips
+    python run_pipeline.py process --rate 2                 # quick look with trips resampled to 2 Hz
+    python run_pipeline.py process --window 5 3             # only 5 s before to 3 s after each event
+    python run_pipeline.py all --dry-run                    # report which stages are stale without running
+
+Interrupted processing resumes from the per-trip checkpoints in ./ProcessedData/checkpoints/,
+use --restart to discard them. Runs with --rate, --steady-state or --window keep their checkpoints and outputs
+in subfolders named after the settings (e.g., ./ProcessedData/rate2/ and ./MatchedEvents/rate2/), so that they
+do not replace the production outputs.
+'''
+import os
+import argparse
+
+path_raw = './RawData/'
+path_cleaned = './CleanedData/'
+path_processed = './ProcessedData/'
+path_matched = './MatchedEvents/'
+
+stages = ['preprocess', 'process', 'match']
+crash_types = ['Crash', 'NearCrash']
+
+
+# Input and output files of each stage, used to decide whether a stage is stale
+def stage_files(stage, crash_type):
+    if stage=='preprocess':
+        inputs = [path_raw + '100CarVehicleInformation.csv',
+                  path_raw + '100CarEventVideoReducedData.csv',
+                  path_raw + 'HundredCar_'+crash_type+'_Public_Compiled.txt']
+        outputs = [path_cleaned + 'HundredCar_metadata_'+crash_type+'Event.csv',
+                   path_cleaned + 'HundredCar_'+crash_type+'_Public_Cleaned.csv']
+    elif stage=='process':
+        inputs = [path_cleaned + 'HundredCar_metadata_'+crash_type+'Event.csv',
+                  path_cleaned + 'HundredCar_'+crash_type+'_Public_Cleaned.csv']
+        outputs = [path_processed + 'HundredCar_'+crash_type+'_Ego.h5',
+                   path_processed + 'HundredCar_'+crash_type+'_Surrounding.h5',
+                   path_processed + 'HundredCar_'+crash_type+'_DataLacked.txt']
+    elif stage=='match':
+        inputs = [path_cleaned + 'HundredCar_metadata_'+crash_type+'Event.csv',
+                  path_processed + 'HundredCar_'+crash_type+'_Ego.h5',
+                  path_processed + 'HundredCar_'+crash_type+'_Surrounding.h5']
+        outputs = [path_matched + 'HundredCar_'+crash_type+'es.h5',
+                   path_matched + 'HundredCar_metadata_'+crash_type+'es.csv']
+    return inputs, outputs
+
+
+# A stage is stale if any output is missing or older than any input, covers only a subset of trips,
+# or was reconstructed with other settings than requested (outputs without recorded settings included)
+def stage_status(stage, crash_type, settings=None):
+    inputs, outputs = stage_files(stage, crash_type)
+    missing_inputs = [f for f in inputs if not os.path.exists(f)]
+    missing_outputs = [f for f in outputs if not os.path.exists(f)]
+    if len(missing_outputs)>0:
+        return 'stale', 'missing ' + ', '.join(os.path.basename(f) for f in missing_outputs)
+    if stage in ['process','match']:
+        from utils_io import load_attributes
+        attributes = load_attributes(outputs[0])
+        if attributes.get('complete', 1.)==0.:
+            return 'stale', 'outputs cover a subset of trips'
+        if settings is not None and {key: attributes.get(key) for key in settings}!=settings:
+            return 'stale', 'outputs made with other settings'
+    if len(missing_inputs)>0:
+        return 'up to date', 'inputs unavailable: ' + ', '.join(os.path.basename(f) for f in missing_inputs)
+    newest_input = max(os.path.getmtime(f) for f in inputs)
+    oldest_output = min(os.path.getmtime(f) for f in outputs)
+    if oldest_output<newest_input:
+        return 'stale', 'inputs changed since last run'
+    return 'up to date', ''
+
+
+def count_checkpoints(crash_type):
+    checkpoint_dir = path_processed + 'checkpoints/' + crash_type + '/'
+    if not os.path.exists(checkpoint_dir):
+        return 0
+    return len([f for f in os.listdir(checkpoint_dir) if f.endswith('.h5')])
+
+
+def report_status(selected_stages, selected_types, settings=None):
+    for crash_type in selected_types:
+        for stage in selected_stages:
+            status, reason = stage_status(stage, crash_type, settings)
+            line = f'{crash_type:<10}{stage:<12}{status:<12}{reason}'
+            if stage=='process':
+                line += f' ({count_checkpoints(crash_type)} trips checkpointed)'
+            print(line)
+
+
+# Stage modules are imported when the stage runs, so that e.g. a status report does not load the processing dependencies
+def run_stage(stage, crash_type, args):
+    if stage=='preprocess':
+        from preprocessing_100Car import preprocess_metadata, preprocess_timeseries
+        preprocess_metadata(path_raw, path_cleaned)
+        preprocess_timeseries(crash_type, path_raw, path_cleaned)
+    elif stage=='process':
+        from processing_100Car import process_crash_type
+        process_crash_type(crash_type, trips=args.trips, restart=args.restart, plot=not args.no_plots, rate=args.rate,
+                           steady_state=args.steady_state, window=args.window, warmup=args.warmup,
+                           path_cleaned=path_cleaned, path_processed=path_processed)
+    elif stage=='match':
+        from event_matching import match_events
+        os.makedirs(path_matched, exist_ok=True)
+        match_events(crash_type, trips=args.trips, path_cleaned=path_cleaned,
+                     path_processed=path_processed, path_matched=path_matched)
+
+
+def positive_float(value):
+    value = float(value)
+    if value<=0:
+        raise argparse.ArgumentTypeError('must be positive, got ' + str(value))
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconstruct trajectories of crashes and near-crashes from 100-Car NDS data.')
+    parser.add_argument('stage', choices=stages+['all','status'],
+                        help='stage to run; "all" runs the stale stages in order, "status" reports stale stages')
+    parser.add_argument('--crash-type', nargs='+', choices=crash_types, default=crash_types,
+                        help='event severity to process (default: both)')
+    parser.add_argument('--trips', nargs='+', type=int, default=None,
+                        help='only process/match these trip ids (webfileid), the outputs keep the other trips; '
+                             'trips with a current checkpoint are restored, add --restart to reprocess them')
+    parser.add_argument('--restart', action='store_true',
+                        help='discard per-trip checkpoints and process all selected trips again')
+    parser.add_argument('--no-plots', action='store_true',
+                        help='skip the comparison plots of ego reconstruction, so that matplotlib is never imported')
+    parser.add_argument('--rate', type=positive_float, default=None,
+                        help='resample trips to this rate in Hz before reconstruction by keeping one in every k frames, so it has to be '
+                             'the native rate divided by a whole number, e.g. 2 for a quick look at 10 Hz data (default: native rate)')
+    parser.add_argument('--steady-state', action='store_true',
+                        help='freeze converged Kalman gains over constant-dt segments (see utils_ekf.py for the accuracy bound)')
+    parser.add_argument('--window', nargs=2, type=float, default=None, metavar=('PRE','POST'),
+                        help='only reconstruct [event start - PRE, event end + POST] seconds of each trip (default: entire trip)')
+    parser.add_argument('--warmup', type=float, default=3.,
+                        help='seconds reconstructed on both sides of the window for the filters to converge (default: 3)')
+    parser.add_argument('--force', action='store_true',
+                        help='with "all", run every stage even if it is up to date')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report which of the selected stages are stale without running them')
+    args = parser.parse_args()
+
+    selected_stages = stages if args.stage in ['all','status'] else [args.stage]
+    from utils_io import reconstruction_settings, settings_tag
+    settings = reconstruction_settings(args.rate, args.steady_state, args.window, args.warmup)
+    ## runs with other settings than the defaults (e.g., a quick look) are kept apart from the production outputs
+    global path_processed, path_matched
+    tag = settings_tag(settings)
+    if tag!='':
+        path_processed, path_matched = path_processed + tag + '/', path_matched + tag + '/'
+        print('Processed and matched data of these settings are kept in', path_processed, 'and', path_matched)
+    if args.stage=='status' or args.dry_run:
+        report_status(selected_stages, args.crash_type, settings)
+        return
+
+    for crash_type in args.crash_type:
+        for stage in selected_stages:
+            if args.stage=='all' and not args.force:
+                status, _ = stage_status(stage, crash_type, settings)
+                ### selected trips are (re)processed and matched on request, the cleaned data only if it is stale
+                if status=='up to date' and (stage=='preprocess' or args.trips is None):
+                    print('Skipping', stage, 'of', crash_type, 'data (up to date)')
+                    continue
+            run_stage(stage, crash_type, args)
+
+
+if __name__ == '__main__':
+    main()
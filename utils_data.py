@@ -3,8 +3,99 @@ This script contains functions for data processing.
 '''
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from utils_ekf import reconstruct_ego, reconstruct_surrounding
+from utils_ekf import reconstruct_ego, reconstruct_surrounding, invalid_speed
+
+
+# Compile the metadata (indexed by webfileid) into a columnar record array,
+# so that per-trip loops index arrays instead of looking up rows with meta.loc
+def compile_metadata(meta):
+    records = np.rec.fromarrays([meta.index.values.astype(int),
+                                 meta['ego_width'].values.astype(float),
+                                 meta['ego_length'].values.astype(float),
+                                 meta['target_width'].values.astype(float),
+                                 meta['target_length'].values.astype(float),
+                                 meta['event start'].values.astype(int),
+                                 meta['event end'].values.astype(int),
+                                 meta['target'].values.astype(str)],
+                                names=['trip_id','ego_width','ego_length','target_width','target_length',
+                                       'event_start','event_end','target'])
+    trip_row = {trip: row for row, trip in enumerate(records['trip_id'])}
+    return records, trip_row
+
+
+
+# Uniform time step of a time series, or None if there are dropouts or jitter beyond the tolerance (relative to dt)
+def uniform_dt(time, dt, tolerance=0.01):
+    steps = np.diff(time)
+    if len(steps)>0 and np.all(np.abs(steps-dt)<=tolerance*dt):
+        return dt
+    return None
+
+
+
+# Number of rows to step for resampling time steps of dt_native to a rate in Hz
+# Only whole rows are kept (no interpolation of the radar targets), so the rate has to be the native rate divided by
+# a whole number (within the tolerance)
+def resampling_step(dt_native, rate=None, tolerance=0.01):
+    if rate is None:
+        return 1
+    if rate<=0:
+        raise ValueError('The resampling rate has to be positive, got ' + str(rate))
+    step = 1/(rate*dt_native)
+    if step<1-tolerance or abs(step-round(step))>tolerance*step:
+        raise ValueError('The resampling rate has to be the native rate (' + f'{1/dt_native:g}' +
+                         ' Hz) divided by a whole number, got ' + f'{rate:g}' + ' Hz')
+    return int(round(step))
+
+
+
+# Resample a trip (rows of the cleaned data) to a uniform rate ahead of the EKF
+# rate: target sampling rate in Hz (see resampling_step), None keeps the native rate (for production)
+# anchor: row to be kept when downsampling, e.g., the start of the event
+def resample_trip(sample, rate=None, anchor=0, tolerance=0.01):
+    dt_native = np.median(np.diff(sample[:,2].astype(float)))
+    step = resampling_step(dt_native, rate, tolerance)
+    if step>1:
+        sample = sample[np.arange(anchor%step, len(sample), step)]
+    dt = uniform_dt(sample[:,2].astype(float), dt_native*step, tolerance)
+    return sample, dt
+
+
+
+# Cut a trip (rows of the cleaned data) to [event start - pre, event end + post] in seconds before reconstruction
+# warmup: extra seconds on both sides for the EKF to converge, as the ego reconstruction may also run in reverse
+# Radar targets that are not alive at the event start are removed up front (their ids set to 0)
+def select_event_window(sample, event_start, event_end, pre, post, warmup=3.):
+    time = sample[:,2].astype(float)
+    row_start, row_end = np.minimum(np.searchsorted(sample[:,1], [event_start, event_end]), len(sample)-1) # sync -> row
+    time_window = (time[row_start]-pre, time[row_end]+post)
+
+    sample = sample.copy()
+    for columns in [slice(20,27), slice(27,34)]: # forward and rearward targets
+        targets = sample[:,columns]
+        alive = np.intersect1d(targets[:row_start+1], targets[row_start+1:])
+        targets[~np.isin(targets, alive)] = 0
+    rows = (time>=time_window[0]-warmup)&(time<=time_window[1]+warmup)
+    return sample[rows], time_window
+
+
+
+# Frames missing before each row of a time series sampled every dt (the median step if None)
+def find_gaps(time, dt=None):
+    if dt is None:
+        dt = np.median(np.diff(time))
+    return np.r_[False, np.diff(time)>1.5*dt]
+
+
+
+# Identify dropouts up front, so that the EKF steps across them with one-sided time steps
+def mask_gaps(df_ego, dt=None):
+    df_ego['gap'] = find_gaps(df_ego['time'].values.astype(float), dt)
+    ## speed measurement is -1 or drops to 0 during acceleration
+    df_ego['speed_valid'] = np.logical_not(invalid_speed(df_ego['speed_comp'].values.astype(float),
+                                                         df_ego['acc_lon'].values.astype(float)))
+    return df_ego
+
 
 
 # Create dataframes for ego vehicle and surrounding vehicles
@@ -50,8 +141,39 @@ def create_dataframe(sample, target_id=0):
 
 
 
+# Plot the reconstructed ego trajectory against the raw measurements
+# matplotlib is imported here rather than at module level, so that headless processing does not pay for it
+def plot_ego(df_ego, reconstructed, reverse, title, fig_file):
+    from matplotlib.figure import Figure # no pyplot needed to save a figure to file
+
+    fig = Figure(figsize=(15, 3.5))
+    axes = fig.subplots(1, 3)
+    if reconstructed:
+        axes[0].plot(df_ego['time'], df_ego['v_ekf'], marker='o', color='tab:blue')
+        axes[1].plot(df_ego['time'], df_ego['psi_ekf'], marker='o', color='tab:blue')
+        axes[2].plot(df_ego['time'], df_ego['acc_ekf'], marker='o', label='ekf', color='tab:blue')
+    axes[0].plot(df_ego['time'], df_ego['speed_comp'], alpha=0.5, marker='o', markersize=3, color='tab:orange')
+    axes[0].set_xlabel('Time (s)')
+    axes[0].set_title('Speed (m/s)')
+    yaw = (np.cumsum(df_ego['yaw_rate']*np.gradient(df_ego['time']))).values
+    yaw = (yaw + np.pi) % (2.0 * np.pi) - np.pi
+    if reverse:
+        yaw = yaw-yaw[-1]
+    axes[1].plot(df_ego['time'], yaw, alpha=0.5, marker='o', markersize=3, color='tab:orange')
+    axes[1].set_xlabel('Time (s)')
+    axes[1].set_title('Yaw (rad)')
+    axes[2].plot(df_ego['time'], df_ego['acc_lon'], alpha=0.5, marker='o', markersize=3, label='raw', color='tab:orange')
+    axes[2].set_xlabel('Time (s)')
+    axes[2].set_title('Acceleration (m/s^2)')
+    axes[2].legend(loc='lower left')
+    fig.suptitle(title, y=1.05)
+
+    fig.savefig(fig_file, bbox_inches='tight', dpi=300)
+
+
+
 # reconstruct trajectory of the ego vehicle
-def process_ego(df_ego, trip, fig_path):
+def process_ego(df_ego, trip, fig_path, plot=True, dt=None, steady_state=False):
     ego_params = {'uncertainty_init':100.,
                   'uncertainty_speed':10.,
                   'uncertainty_omega':5.,
@@ -66,20 +188,21 @@ def process_ego(df_ego, trip, fig_path):
             valid = np.logical_not(df_ego[acc].isna())
             interpolated = np.interp(df_ego['time'], df_ego['time'][valid], df_ego[acc][valid])
             df_ego[acc] = interpolated
+    df_ego = mask_gaps(df_ego, dt)
     valid_start = np.all(df_ego['speed_comp'].iloc[:5]>=0)
     valid_end = np.all(df_ego['speed_comp'].iloc[-5:]>=0)
     if valid_start and not valid_end:
         reverse = False
-        df_ego = reconstruct_ego(df_ego, ego_params.values(), reverse=False)
+        df_ego = reconstruct_ego(df_ego, ego_params.values(), reverse=False, dt=dt, steady_state=steady_state)
     elif valid_end and not valid_start:
         reverse = True
-        df_ego = reconstruct_ego(df_ego, ego_params.values(), reverse=True)
+        df_ego = reconstruct_ego(df_ego, ego_params.values(), reverse=True, dt=dt, steady_state=steady_state)
     elif not valid_start and not valid_end:
         reverse = False
         print('\n Trip ', trip, ' lacks initial speed')
     elif valid_start and valid_end:
-        df_order = reconstruct_ego(df_ego, ego_params.values(), reverse=False)
-        df_reverse = reconstruct_ego(df_ego, ego_params.values(), reverse=True)
+        df_order = reconstruct_ego(df_ego, ego_params.values(), reverse=False, dt=dt, steady_state=steady_state)
+        df_reverse = reconstruct_ego(df_ego, ego_params.values(), reverse=True, dt=dt, steady_state=steady_state)
         to_count = (df_ego['speed_comp']>=0).values
         error_order = np.sum(np.abs(df_order['v_ekf'] - df_order['speed_comp']).values[to_count])
         error_reverse = np.sum(np.abs(df_reverse['v_ekf'] - df_reverse['speed_comp']).values[to_count])
@@ -93,34 +216,12 @@ def process_ego(df_ego, trip, fig_path):
             df_reverse = None
     
     ## plot and save reconstructed trajectory
-    fig, axes = plt.subplots(1, 3, figsize=(15, 3.5))
-    if valid_start or valid_end:
-        axes[0].plot(df_ego['time'], df_ego['v_ekf'], marker='o', color='tab:blue')
-        axes[1].plot(df_ego['time'], df_ego['psi_ekf'], marker='o', color='tab:blue')
-        axes[2].plot(df_ego['time'], df_ego['acc_ekf'], marker='o', label='ekf', color='tab:blue')
-    axes[0].plot(df_ego['time'], df_ego['speed_comp'], alpha=0.5, marker='o', markersize=3, color='tab:orange')
-    axes[0].set_xlabel('Time (s)')
-    axes[0].set_title('Speed (m/s)')
-    yaw = (np.cumsum(df_ego['yaw_rate']*np.gradient(df_ego['time']))).values
-    yaw = (yaw + np.pi) % (2.0 * np.pi) - np.pi
-    if reverse:
-        yaw = yaw-yaw[-1]
-    axes[1].plot(df_ego['time'], yaw, alpha=0.5, marker='o', markersize=3, color='tab:orange')
-    axes[1].set_xlabel('Time (s)')
-    axes[1].set_title('Yaw (rad)')
-    axes[2].plot(df_ego['time'], df_ego['acc_lon'], alpha=0.5, marker='o', markersize=3, label='raw', color='tab:orange')
-    axes[2].set_xlabel('Time (s)')
-    axes[2].set_title('Acceleration (m/s^2)')
-    axes[2].legend(loc='lower left')
-
-    if valid_start and valid_end:
-        fig.suptitle('Trip id: '+str(trip)+', Reverse: '+str(reverse)+', Error in order: '+str(round(error_order,2))+', Error in reverse: '+str(round(error_reverse,2)),
-                     y=1.05)
-    else:
-        fig.suptitle('Trip id: '+str(trip)+', Reverse: '+str(reverse), y=1.05)
-
-    fig.savefig(fig_path + str(trip) + '.png', bbox_inches='tight', dpi=300)
-    plt.close(fig)
+    if plot:
+        if valid_start and valid_end:
+            title = 'Trip id: '+str(trip)+', Reverse: '+str(reverse)+', Error in order: '+str(round(error_order,2))+', Error in reverse: '+str(round(error_reverse,2))
+        else:
+            title = 'Trip id: '+str(trip)+', Reverse: '+str(reverse)
+        plot_ego(df_ego, valid_start or valid_end, reverse, title, fig_path + str(trip) + '.png')
     
     return df_ego, valid_start|valid_end
 
@@ -146,7 +247,7 @@ def angle_degree(vec1x, vec1y, vec2x, vec2y):
 
 
 # Process surrounding vehicles
-def process_surrounding(df_ego, df_sur, ego_length, forward=True):
+def process_surrounding(df_ego, df_sur, ego_length, forward=True, dt=None, steady_state=False):
     df_sur[['range','range_rate']] = df_sur[['range','range_rate']]*0.3048
     df_ego_sur = df_ego.set_index('time').loc[df_sur['time'].values].reset_index()
     heading_ego = np.array([np.cos(df_ego_sur['psi_ekf'].values), np.sin(df_ego_sur['psi_ekf'].values)]).T
@@ -190,7 +291,9 @@ def process_surrounding(df_ego, df_sur, ego_length, forward=True):
         df_target = df_sur.loc[target_id].reset_index().copy()
         if len(df_target) < 10:
             continue
-        df_target = reconstruct_surrounding(df_target, sur_params.values())
+        dt_target = None if dt is None else uniform_dt(df_target['time'].values.astype(float), dt) # targets may be lost for some frames
+        df_target['gap'] = find_gaps(df_target['time'].values.astype(float), dt)
+        df_target = reconstruct_surrounding(df_target, sur_params.values(), dt_target, steady_state)
         df_sur_ekf.append(df_target)
     df_sur_ekf = pd.concat(df_sur_ekf)
 
@@ -0,0 +1,171 @@
+'''
+This script contains functions to save and load the processed and matched trajectories in a compact format.
+
+A compact file holds
+- /data: per-row values in one compressed array per dtype (column-major), float32 for state columns
+  and the smallest integer types, chunked by whole trips so that single trips are read without
+  loading the entire file
+- /constants: values that are constant per group of consecutive rows (e.g., trip_id, or target_id
+  and forward per target), stored once with the number of rows of the group
+- object, string and categorical columns as integer codes, with their categories as an attribute
+- the column order, original dtypes, and maximum error introduced by float32 per column, as attributes,
+  as well as attributes given by the caller (e.g., the reconstruction settings and whether all trips are included)
+'''
+import numpy as np
+import pandas as pd
+
+
+# Columns that are used as merge keys are kept exact
+exact_columns = ['time']
+
+
+# Settings of the reconstruction, saved with the checkpoints and the outputs so that results made with other settings
+# are not reused (-1 for window settings that are not used)
+def reconstruction_settings(rate=None, steady_state=False, window=None, warmup=3.):
+    return {'rate': 0. if rate is None else float(rate), 'steady_state': float(steady_state),
+            'pre': -1. if window is None else float(window[0]), 'post': -1. if window is None else float(window[1]),
+            'warmup': -1. if window is None else float(warmup)}
+
+
+# Name of the folder that keeps the checkpoints and outputs of other settings than the defaults apart, e.g. 'rate2_window5-3_warmup3',
+# empty for the default settings
+def settings_tag(settings):
+    parts = []
+    if settings['rate']>0:
+        parts.append(f"rate{settings['rate']:g}")
+    if settings['steady_state']>0:
+        parts.append('steady')
+    if settings['pre']>=0:
+        parts.append(f"window{settings['pre']:g}-{settings['post']:g}")
+        parts.append(f"warmup{settings['warmup']:g}")
+    return '_'.join(parts)
+
+
+# Save a dataframe in the compact format
+# group_columns: columns identifying a group of consecutive rows, starting with trip_id
+# constant_columns: columns constant within each group, also moved to the side table
+# tolerance: maximum absolute error allowed when storing a float column as float32, otherwise it stays float64
+# attributes: dictionary saved with the data, read back with load_attributes
+def save_compact(df, file_path, group_columns=['trip_id'], constant_columns=[], tolerance=1e-3, complevel=9, attributes={}):
+    ## encode object, string and categorical columns as integer codes, other columns have to be numeric or bool
+    dtypes = list(df.dtypes.astype(str))
+    categories = {}
+    for column in df.columns:
+        if (pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column]) or
+            isinstance(df[column].dtype, pd.CategoricalDtype)):
+            values = pd.Categorical(df[column])
+            categories[column] = list(values.categories)
+            df = df.assign(**{column: values.codes})
+        elif df[column].dtype.kind not in 'biuf':
+            raise ValueError('Column ' + str(column) + ' of dtype ' + str(df[column].dtype) + ' is not supported, '
+                             'only numeric, bool, string and categorical columns are')
+
+    ## move per-group constants to a side table, groups have to be consecutive rows
+    values = df[group_columns+constant_columns].values
+    new_group = np.ones(len(df), dtype=bool)
+    new_group[1:] = np.any(values[1:]!=values[:-1], axis=1)
+    constants = df.loc[new_group, group_columns+constant_columns].reset_index(drop=True)
+    if len(constants)>len(df[group_columns].drop_duplicates()):
+        raise ValueError('Rows are not ordered by ' + str(group_columns) + ', or ' + str(constant_columns) + ' are not constant within the groups')
+    constants['rows'] = np.diff(np.r_[np.flatnonzero(new_group), len(df)])
+    for column in constants.columns:
+        if pd.api.types.is_integer_dtype(constants[column]):
+            constants[column] = pd.to_numeric(constants[column], downcast='integer')
+
+    ## downcast per-row values, float32 only if the precision is verified
+    data = {}
+    max_error = {}
+    for column in df.columns.drop(group_columns+constant_columns):
+        values = df[column].values
+        if pd.api.types.is_float_dtype(values) and column not in exact_columns:
+            values_32 = values.astype(np.float32)
+            error = np.abs(values_32.astype(float)-values)
+            max_error[column] = float(np.nanmax(error)) if np.any(np.isfinite(error)) else 0.
+            if max_error[column]<=tolerance:
+                values = values_32
+        elif pd.api.types.is_integer_dtype(values):
+            values = pd.to_numeric(values, downcast='integer')
+        ### one block per stored and original dtype
+        data.setdefault((values.dtype.str, df[column].dtype.str), []).append((column, values))
+
+    ## a chunk holds a whole number of typical trips
+    trip_rows = max(1, int(np.median(constants.groupby('trip_id', sort=False)['rows'].sum()))) if len(df)>0 else 1
+    chunk_rows = max(1, 8192//trip_rows)*trip_rows
+
+    import tables # only needed for reading and writing, so that importing the processing stays fast
+    filters = tables.Filters(complevel=complevel, complib='blosc:lz4', shuffle=True)
+    with tables.open_file(file_path, mode='w', filters=filters) as h5:
+        h5.root._v_attrs.columns = list(df.columns)
+        h5.root._v_attrs.dtypes = dtypes
+        h5.root._v_attrs.max_error = max_error
+        h5.root._v_attrs.categories = categories
+        h5.root._v_attrs.attributes = dict(attributes)
+        h5.create_table('/', 'constants', obj=constants.to_records(index=False))
+        group = h5.create_group('/', 'data')
+        for i, (dtype, columns) in enumerate(data.items()):
+            block = np.vstack([values for _, values in columns])
+            node = h5.create_earray(group, 'block_'+str(i), atom=tables.Atom.from_dtype(block.dtype), shape=(block.shape[0], 0),
+                                    chunkshape=(block.shape[0], max(1, min(chunk_rows, block.shape[1]))))
+            node.append(block)
+            node.attrs.columns = [column for column, _ in columns]
+
+
+# Load a dataframe in its original layout (with a new RangeIndex), optionally for selected trips only
+# float64: restore float32 columns to float64 as in the original layout
+def load_compact(file_path, trips=None, float64=True):
+    import tables
+    with tables.open_file(file_path, mode='r') as h5:
+        if '/constants' not in h5: # saved with DataFrame.to_hdf
+            h5.close()
+            df = pd.read_hdf(file_path, key='data')
+            if trips is not None:
+                df = df[df['trip_id'].isin(trips)].reset_index(drop=True)
+            return df
+
+        constants = pd.DataFrame(h5.root.constants.read())
+        offsets = np.r_[0, np.cumsum(constants['rows'].values)]
+        if trips is None:
+            ranges = [(0, offsets[-1])]
+        else:
+            selected = np.flatnonzero(constants['trip_id'].isin(trips).values)
+            constants = constants.iloc[selected]
+            ### groups of the same trip are adjacent, so they are read in one slice
+            starts, stops = offsets[selected], offsets[selected+1]
+            first, last = np.ones(len(selected), dtype=bool), np.ones(len(selected), dtype=bool)
+            first[1:] = last[:-1] = starts[1:]!=stops[:-1]
+            ranges = list(zip(starts[first], stops[last]))
+
+        columns = h5.root._v_attrs.columns
+        dtypes = dict(zip(columns, h5.root._v_attrs.dtypes))
+        categories = h5.root._v_attrs.categories if 'categories' in h5.root._v_attrs else {}
+        frames = []
+        for node in h5.root.data:
+            if len(ranges)==1:
+                block = node[:, ranges[0][0]:ranges[0][1]]
+            else:
+                block = np.hstack([node[:, start:stop] for start, stop in ranges] + [node[:, :0]])
+            ### restore the original dtype of the entire block at once (codes are decoded below), and wrap it without copying
+            dtype = dtypes[node.attrs.columns[0]] if node.attrs.columns[0] not in categories else block.dtype
+            if block.dtype!=dtype and (float64 or block.dtype.kind!='f'):
+                block = block.astype(dtype)
+            frames.append(pd.DataFrame(block.T, columns=list(node.attrs.columns), copy=False))
+
+    constants = {column: np.repeat(constants[column].values.astype(dtypes[column] if column not in categories else int),
+                                   constants['rows'].values)
+                 for column in constants.columns.drop('rows')}
+    frames.append(pd.DataFrame(constants))
+    df = pd.concat(frames, axis=1)[columns]
+    for column, values in categories.items():
+        df[column] = pd.Categorical.from_codes(df[column].values, values)
+        if dtypes[column]!='category':
+            df[column] = df[column].astype(dtypes[column])
+    return df
+
+
+# Attributes saved with the data, empty for files without them
+def load_attributes(file_path):
+    import tables
+    with tables.open_file(file_path, mode='r') as h5:
+        if 'attributes' not in h5.root._v_attrs:
+            return {}
+        return dict(h5.root._v_attrs.attributes)
@@ -3,14 +3,14 @@ This script contains functions for visualization.
 '''
 
 import matplotlib.pyplot as plt
-plt.rcParams.update({'font.size': 8})
 from matplotlib.patches import Rectangle
 from matplotlib import colors
 from matplotlib.collections import PatchCollection
 import numpy as np
-from IPython.display import display, clear_output
 import time as systime
 
+font_params = {'font.size': 8} # applied when drawing rather than at import
+
 
 class RotateRectangle(Rectangle): # adapted from a Stack Overflow answer https://stackoverflow.com/a/60413175
     def __init__(self, xy, width, length, rotate_ref_x, rotate_ref_y, **kwargs):
@@ -72,7 +72,9 @@ def draw_events(ax, event_t, rotate_ref_x, rotate_ref_y, annotate=False):
     return ax
 
 
+@plt.rc_context(font_params)
 def visualize_trip(df_ego, df_sur, trip_id):
+    from IPython.display import display, clear_output # only needed for showing frames in the notebook
     xlim = [min(df_ego['x_ekf'].min(), df_sur['x_ekf'].min())-5, 
             max(df_ego['x_ekf'].max(), df_sur['x_ekf'].max())+5]
     ylim = [min(df_ego['y_ekf'].min(), df_sur['y_ekf'].min())-5, 
@@ -105,6 +107,7 @@ def visualize_trip(df_ego, df_sur, trip_id):
         plt.close(fig)
 
 
+@plt.rc_context(font_params)
 def visualize_event(events, trip_id, save=False, save_dir='./'):
     xlim = [min(events['x_i'].min(), events['x_j'].min()), 
             max(events['x_i'].max(), events['x_j'].max())]
@@ -136,6 +139,7 @@ def visualize_event(events, trip_id, save=False, save_dir='./'):
             fig.savefig(save_dir+f'frame_{int(round(t,2)*100)}.png', bbox_inches='tight', dpi=400)
             plt.close(fig)
         else:
+            from IPython.display import display, clear_output # only needed for showing frames in the notebook
             display(fig)
             systime.sleep(0.01)
             clear_output(wait=True)